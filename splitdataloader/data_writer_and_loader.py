@@ -12,35 +12,100 @@ The class SplitDataLoader provides the functions required for loading data. It s
 length calculation and indexing.
 """
 
+import mmap
+import os
+import queue
 import struct
 import shutil
 import random
+import threading
+import weakref
 
-from typing import Iterable, Iterator, BinaryIO
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Iterable, Iterator, BinaryIO, Sequence
 from pathlib import Path
 
-# Used for storing size (uint32)
-STRUCT_NUM_FORMAT = "<I"
+# Used for storing size (uint32). Structs are pre-compiled for the hot paths.
+_U32 = struct.Struct("<I")
 # Number of bytes required to store size
-STRUCT_NUM_FORMAT_SIZE = struct.calcsize(STRUCT_NUM_FORMAT)
+_U32_SIZE = _U32.size
+# The index file starts with a header: magic and the layout of the entries that follow.
+# Index files written by older versions have no header and use INDEX_LAYOUT_LEGACY.
+_INDEX_HEADER = struct.Struct("<4sB3x")
+INDEX_MAGIC = b"SDLI"
+# Triplet of (index, position, length), each in U32
+INDEX_LAYOUT_LEGACY = 0
+# Index (U8) and position (U56) packed in a single U64. For up to 256 splits.
+INDEX_LAYOUT_PACKED = 1
+# Pair of index (U32) and position (U64)
+INDEX_LAYOUT_WIDE = 2
+_IDX = struct.Struct("<III")
+_IDX_PACKED = struct.Struct("<Q")
+_IDX_WIDE = struct.Struct("<IQ")
+_POSITION_BITS = 56
+_POSITION_MASK = (1 << _POSITION_BITS) - 1
+# Entry size for each layout
+INDEX_ENTRY_SIZES = {
+    INDEX_LAYOUT_LEGACY: _IDX.size,
+    INDEX_LAYOUT_PACKED: _IDX_PACKED.size,
+    INDEX_LAYOUT_WIDE: _IDX_WIDE.size,
+}
+# Encoders of (index, position, length) for each layout
+INDEX_ENTRY_PACKERS: dict[int, Callable[[int, int, int], bytes]] = {
+    INDEX_LAYOUT_LEGACY: _IDX.pack,
+    INDEX_LAYOUT_PACKED: lambda index, position, _: _IDX_PACKED.pack(
+        index << _POSITION_BITS | position
+    ),
+    INDEX_LAYOUT_WIDE: lambda index, position, _: _IDX_WIDE.pack(index, position),
+}
+# Buffer size used for the files written by write_split_data()
+WRITE_BUFFER_SIZE = 1 << 20
+# Maximum number of records waiting for each worker of write_split_data()
+WORKER_QUEUE_SIZE = 64
+# Default number of packets shuffled together by SplitDataLoader.iterate_binwise()
+SHUFFLE_CHUNK_SIZE = 65536
+# Default maximum number of bin files kept open by a SplitDataLoader
+MAX_OPEN_BIN_FILES = 256
+# Upper bound of the expected packet size used for packets whose length is not in the
+# index. Larger packets take a second read instead of inflating every later read.
+MAX_SIZE_HINT = 64 << 10
 
 
 def struct_pack_write(writer: BinaryIO, number: int) -> None:
-    writer.write(struct.pack(STRUCT_NUM_FORMAT, number))
+    writer.write(_U32.pack(number))
 
 
 def read_struct_unpack(reader: BinaryIO) -> tuple[bool, int]:
-    data = reader.read(STRUCT_NUM_FORMAT_SIZE)
+    data = reader.read(_U32_SIZE)
     if not data:
         return False, 0
-    number = struct.unpack("<I", data)[0]
+    if len(data) != _U32_SIZE:
+        raise IOError(f"Read size mismatch: {len(data)} != {_U32_SIZE}")
+    (number,) = _U32.unpack(data)
     return True, number
 
 
-def write_size_prefixed(writer: BinaryIO, data: bytes) -> None:
-    """Write size and data"""
-    struct_pack_write(writer, len(data))
-    writer.write(data)
+def write_size_prefixed(writer: BinaryIO | int, data: bytes) -> None:
+    """
+    Write size and data
+
+    writer can also be a file descriptor, in which case both are written with a single
+    writev() call where available.
+    """
+    if not isinstance(writer, int):
+        struct_pack_write(writer, len(data))
+        writer.write(data)
+        return
+    size = _U32.pack(len(data))
+    written = 0
+    if hasattr(os, "writev"):
+        written = os.writev(writer, (size, data))
+    if written < len(size) + len(data):
+        # Partial write (or no writev): write the rest
+        remaining = memoryview(size + data)[written:]
+        while remaining:
+            remaining = remaining[os.write(writer, remaining) :]
 
 
 def read_size_prefixed(reader: BinaryIO) -> tuple[bool, bytes]:
@@ -58,6 +123,25 @@ def read_size_prefixed(reader: BinaryIO) -> tuple[bool, bytes]:
     return True, data
 
 
+def iterate_size_prefixed_packets(buffer: bytes | mmap.mmap) -> Iterator[bytes]:
+    """
+    Iterate over all the size prefixed packets in the buffer.
+
+    Sizes are decoded in place, so the only copy made is the packet itself.
+    """
+    offset = 0
+    end = len(buffer)
+    while offset < end:
+        if offset + _U32_SIZE > end:
+            raise IOError(f"Truncated size at {offset}")
+        (size,) = _U32.unpack_from(buffer, offset)
+        offset += _U32_SIZE
+        if offset + size > end:
+            raise IOError(f"Read size mismatch: {end - offset} != {size}")
+        yield buffer[offset : offset + size]
+        offset += size
+
+
 def read_all_size_prefixed_packets(reader: BinaryIO) -> list[bytes]:
     result = []
     while True:
@@ -68,6 +152,84 @@ def read_all_size_prefixed_packets(reader: BinaryIO) -> list[bytes]:
     return result
 
 
+def iterate_bin_file(bin_file: str, drop_cache: bool = False) -> Iterator[bytes]:
+    """
+    Iterate over the packets in a bin file, without keeping them in memory.
+
+    drop_cache: if true, ask the kernel to drop the file from the page cache afterwards
+    """
+    fd = os.open(bin_file, os.O_RDONLY)
+    try:
+        # The whole file is read front to back, so read-ahead can be aggressive
+        advise_file(fd, "POSIX_FADV_SEQUENTIAL")
+        advise_file(fd, "POSIX_FADV_WILLNEED")
+        mm = map_fd(fd)
+        advise_mapping(mm, "MADV_SEQUENTIAL")
+        try:
+            yield from iterate_size_prefixed_packets(mm)
+        finally:
+            # Pages still mapped are not dropped, so unmap first
+            if isinstance(mm, mmap.mmap):
+                mm.close()
+            if drop_cache:
+                advise_file(fd, "POSIX_FADV_DONTNEED")
+    finally:
+        os.close(fd)
+
+
+def read_bin_packets(bin_file: str, drop_cache: bool = False) -> list[bytes]:
+    """Read all the packets in a bin file. See iterate_bin_file()."""
+    return list(iterate_bin_file(bin_file, drop_cache))
+
+
+def iterate_bin_packets(
+    bin_files: list[str], prefetch: int = 0, drop_cache: bool = False
+) -> Iterator[Iterable[bytes]]:
+    """
+    Yield the packets of each bin file (in the given order).
+
+    prefetch: if non-zero, read up to this many upcoming bins (in full) in background
+        threads. Otherwise the packets of each bin are streamed.
+    drop_cache: if true, drop each bin from the page cache after reading it
+    """
+    if prefetch <= 0:
+        for bin_file in bin_files:
+            yield iterate_bin_file(bin_file, drop_cache)
+        return
+
+    pool = ThreadPoolExecutor(prefetch)
+    try:
+        pending = deque(
+            pool.submit(read_bin_packets, f, drop_cache) for f in bin_files[:prefetch]
+        )
+        for bin_file in bin_files[prefetch:]:
+            packets = pending.popleft().result()
+            pending.append(pool.submit(read_bin_packets, bin_file, drop_cache))
+            yield packets
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        # Reads are not needed anymore if the consumer stopped early
+        pool.shutdown(cancel_futures=True)
+
+
+def shuffle_in_chunks(packets: Iterable[bytes], chunk_size: int) -> Iterator[bytes]:
+    """
+    Shuffle packets within consecutive chunks of chunk_size (0 for a single chunk).
+
+    Only one chunk is kept in memory at a time.
+    """
+    chunk: list[bytes] = []
+    for data in packets:
+        chunk.append(data)
+        if len(chunk) == chunk_size:
+            random.shuffle(chunk)
+            yield from chunk
+            chunk = []
+    random.shuffle(chunk)
+    yield from chunk
+
+
 def get_index_file(data_dir_path: Path) -> Path:
     return data_dir_path / "index.dat"
 
@@ -77,12 +239,70 @@ def get_bin_file_for_index(data_dir_path: Path, index: int) -> Path:
     return data_dir_path / file_name_pattern.format(index)
 
 
+def read_index_header(data: bytes | mmap.mmap) -> tuple[int, int]:
+    """
+    Return (layout, offset of the first entry), given the start of an index file.
+    """
+    if len(data) >= _INDEX_HEADER.size:
+        magic, layout = _INDEX_HEADER.unpack_from(data)
+        if magic == INDEX_MAGIC:
+            if layout not in INDEX_ENTRY_SIZES:
+                raise ValueError(f"Unknown index layout {layout}")
+            return layout, _INDEX_HEADER.size
+    return INDEX_LAYOUT_LEGACY, 0
+
+
+def map_fd(fd: int) -> mmap.mmap | bytes:
+    """
+    Map the open file to memory (read-only).
+
+    mmap cannot map an empty file, so an empty bytes object is returned instead. Both
+    support len(), slicing, and struct unpack_from().
+    """
+    if not os.fstat(fd).st_size:
+        return b""
+    return mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+
+
+def map_file(file_path: Path | str) -> mmap.mmap | bytes:
+    """Map the file to memory (read-only). See map_fd()."""
+    fd = os.open(file_path, os.O_RDONLY)
+    try:
+        return map_fd(fd)
+    finally:
+        os.close(fd)
+
+
+def advise_mapping(mm: mmap.mmap | bytes, advice: str) -> None:
+    """
+    Give the kernel a hint about the access pattern of a mapping.
+
+    advice: name of the mmap constant, eg: "MADV_RANDOM". Ignored if the platform does
+    not support it.
+    """
+    if isinstance(mm, mmap.mmap) and hasattr(mmap, advice):
+        mm.madvise(getattr(mmap, advice))
+
+
+def advise_file(fd: int, advice: str) -> None:
+    """
+    Give the kernel a hint about how the whole file is going to be accessed.
+
+    advice: name of the os constant, eg: "POSIX_FADV_RANDOM". Ignored if the platform
+    does not support it.
+    """
+    if hasattr(os, "posix_fadvise") and hasattr(os, advice):
+        os.posix_fadvise(fd, 0, 0, getattr(os, advice))
+
+
 def write_split_data(
     target_dir: str,
     input_sequence: Iterable[bytes],
     splits: int = 256,
     shuffle: bool = False,
     start_clean: bool = False,
+    num_workers: int = 0,
+    buffer_in_memory: bool = False,
 ) -> None:
     """
     Write a sequence of data to multiple bins.
@@ -92,6 +312,9 @@ def write_split_data(
     splits: number of splits to use
     shuffle: if true, shuffle the order of bins
     start_clean: if true, clear the contents of target_dir before start
+    num_workers: if non-zero, write the bin files from this many threads
+    buffer_in_memory: if true, collect the data of every bin in memory and write each bin
+        file at once at the end. Much faster, if all the data fits in memory.
 
     After the operation, the `target_dir` will contain all the bin files and an index file.
     Shuffle only shuffles the order of how bins are selected.
@@ -103,8 +326,20 @@ def write_split_data(
     # Create if the dir does not exist
     data_dir_path.mkdir(parents=True, exist_ok=True)
     # To be used for storing index data.
-    # Each step involve writing (index, position, length)
+    # Each step involve writing (index, position) and, in the legacy layout, length
     index_file_path = get_index_file(data_dir_path)
+    # Keep the layout of an existing index, so that data can be appended to it
+    index_header = b""
+    if index_file_path.exists():
+        with open(index_file_path, "rb") as reader:
+            index_header = reader.read(_INDEX_HEADER.size)
+    if index_header:
+        layout, _ = read_index_header(index_header)
+    else:
+        layout = INDEX_LAYOUT_PACKED if splits <= 256 else INDEX_LAYOUT_WIDE
+    if layout == INDEX_LAYOUT_PACKED and splits > 256:
+        raise ValueError(f"Existing index supports at most 256 splits, got {splits=}")
+    pack_index_entry = INDEX_ENTRY_PACKERS[layout]
 
     # Indexes to be used for when shuffle is used.
     indexes = []
@@ -113,52 +348,337 @@ def write_split_data(
         random.shuffle(indexes)
 
     # For every step, we update the index data
-    index_file = open(index_file_path, "ab")
+    index_file = open(index_file_path, "ab", buffering=WRITE_BUFFER_SIZE)
+    if not index_header:
+        index_file.write(_INDEX_HEADER.pack(INDEX_MAGIC, layout))
+    # End position of each bin file, tracked here instead of calling tell()
+    bin_positions: dict[int, int] = {}
+
+    def records() -> Iterator[tuple[int, bytes]]:
+        """Assign each packet to a bin, update the index and yield (bin index, data)"""
+        for frame_idx, data in enumerate(input_sequence):
+            idx = frame_idx % splits
+            if shuffle:
+                idx = indexes[idx]
+
+            position = bin_positions.get(idx)
+            if position is None:
+                bin_file = get_bin_file_for_index(data_dir_path, idx)
+                position = bin_file.stat().st_size if bin_file.exists() else 0
+            length = len(data)
+            bin_positions[idx] = position + _U32_SIZE + length
+
+            # Update index file
+            index_file.write(pack_index_entry(idx, position, length))
+            yield idx, data
+
+    try:
+        if buffer_in_memory:
+            write_bin_records_in_memory(data_dir_path, records(), num_workers)
+        elif num_workers > 0:
+            write_bin_records_parallel(data_dir_path, records(), num_workers)
+        else:
+            write_bin_records(data_dir_path, records())
+    finally:
+        index_file.close()
 
-    for frame_idx, data in enumerate(input_sequence):
-        idx = frame_idx % splits
-        if shuffle:
-            idx = indexes[idx]
 
-        bin_file = get_bin_file_for_index(data_dir_path, idx)
+def write_bin_records(data_dir_path: Path, records: Iterable[tuple[int, bytes]]) -> None:
+    """
+    Append each data (size prefixed) to the bin file with the given index.
 
-        # Get binary file for this data
-        position = 0
-        length = len(data)
-        # Write data (size prefixed)
-        with open(bin_file, "ab") as writer:
-            # Get current position
-            position = writer.tell()
-            struct_pack_write(writer, length)
-            writer.write(data)
+    Bin files are opened on first use and kept open until all the records are written.
+    """
+    bin_writers: dict[int, BinaryIO] = {}
+    try:
+        for idx, data in records:
+            writer = bin_writers.get(idx)
+            if writer is None:
+                bin_file = get_bin_file_for_index(data_dir_path, idx)
+                writer = open(bin_file, "ab", buffering=WRITE_BUFFER_SIZE)
+                bin_writers[idx] = writer
+            if len(data) < WRITE_BUFFER_SIZE:
+                write_size_prefixed(writer, data)
+            else:
+                # Would bypass the buffer anyway: write size and data with one call
+                writer.flush()
+                write_size_prefixed(writer.fileno(), data)
+    finally:
+        for writer in bin_writers.values():
+            writer.close()
+
+
+def write_bin_records_parallel(
+    data_dir_path: Path, records: Iterable[tuple[int, bytes]], num_workers: int
+) -> None:
+    """
+    Same as write_bin_records(), but bins are written from num_workers threads.
 
-        # Update index file
-        for value in (idx, position, length):
-            struct_pack_write(index_file, value)
+    Each worker owns the bins with idx % num_workers equal to its number, so the order
+    of records within a bin is preserved.
+    """
+    worker_queues: list[queue.Queue[tuple[int, bytes] | None]] = [
+        queue.Queue(WORKER_QUEUE_SIZE) for _ in range(num_workers)
+    ]
+    # Set by a failing worker, so that the producer stops reading the input
+    failed = threading.Event()
+
+    def worker(records_q: queue.Queue[tuple[int, bytes] | None]) -> None:
+        finished = False
+
+        def queued_records() -> Iterator[tuple[int, bytes]]:
+            nonlocal finished
+            while True:
+                record = records_q.get()
+                if record is None:
+                    finished = True
+                    return
+                yield record
+
+        try:
+            write_bin_records(data_dir_path, queued_records())
+        except BaseException:
+            failed.set()
+            # Keep consuming, so that the producer does not block forever. Closing the
+            # bin files can fail after the end marker is already taken.
+            if not finished:
+                while records_q.get() is not None:
+                    pass
+            raise
+
+    with ThreadPoolExecutor(num_workers) as pool:
+        futures = [pool.submit(worker, records_q) for records_q in worker_queues]
+        try:
+            for idx, data in records:
+                if failed.is_set():
+                    break
+                worker_queues[idx % num_workers].put((idx, data))
+        finally:
+            for records_q in worker_queues:
+                records_q.put(None)
+        for future in futures:
+            future.result()
+
+
+def release_loader_resources(
+    idx_mm: mmap.mmap | bytes,
+    bin_fds: dict[int, int],
+    evicted_fds: set[int],
+    executor: ThreadPoolExecutor | None,
+) -> None:
+    """Release everything held by a SplitDataLoader. Used as its finalizer."""
+    if executor is not None:
+        executor.shutdown()
+    if isinstance(idx_mm, mmap.mmap):
+        idx_mm.close()
+    while bin_fds:
+        _, fd = bin_fds.popitem()
+        os.close(fd)
+    while evicted_fds:
+        os.close(evicted_fds.pop())
+
+
+def write_bin_records_in_memory(
+    data_dir_path: Path, records: Iterable[tuple[int, bytes]], num_workers: int = 0
+) -> None:
+    """
+    Same as write_bin_records(), but the data of each bin is collected in memory first.
 
-    index_file.close()
+    Each bin file is then written with a single sequential write, from num_workers
+    threads if non-zero.
+    """
+    buckets: dict[int, bytearray] = {}
+
+    def write_bucket(idx: int) -> None:
+        # Drop the bucket as soon as it is written
+        bucket = buckets.pop(idx)
+        with open(get_bin_file_for_index(data_dir_path, idx), "ab") as writer:
+            writer.write(bucket)
+
+    try:
+        for idx, data in records:
+            bucket = buckets.get(idx)
+            if bucket is None:
+                bucket = buckets[idx] = bytearray()
+            bucket += _U32.pack(len(data))
+            bucket += data
+    finally:
+        # The index entries of the records are already written. The collected data is
+        # written even if records fails part way, so that the index stays valid.
+        if num_workers > 0:
+            with ThreadPoolExecutor(num_workers) as pool:
+                list(pool.map(write_bucket, list(buckets)))
+        else:
+            for idx in list(buckets):
+                write_bucket(idx)
 
 
 class SplitDataLoader:
     """
     Loader for data written using write_split_data()
+
+    data_dir: directory containing the bin files and the index file
+    io_threads: if non-zero, get_batch() issues its reads from this many threads, keeping
+        several reads in flight to make use of the parallelism of SSDs
+    max_open_files: maximum number of bin files kept open for random access. A file
+        evicted while another thread is reading from it is closed once that read ends,
+        so the limit can be exceeded briefly.
+
+    Indexing and get_batch() can be called from several threads on the same loader.
     """
 
-    def __init__(self, data_dir: str) -> None:
+    def __init__(
+        self,
+        data_dir: str,
+        io_threads: int = 0,
+        max_open_files: int = MAX_OPEN_BIN_FILES,
+    ) -> None:
+        if max_open_files < 1:
+            raise ValueError(f"max_open_files must be at least 1, got {max_open_files}")
         self.data_dir_path = Path(data_dir)
+        self.io_threads = io_threads
+        self.max_open_files = max_open_files
         self.index_file = get_index_file(self.data_dir_path)
-        # Index file contains a triplet of (index, position, length), each in U32
-        self.index_packet_size = 3 * 4
+        # The index is mapped once and shared by all lookups. Note that packets
+        # written after the loader is created are not visible.
+        self._idx_mm = map_file(self.index_file)
+        # Lookups are random, default read-ahead would only pollute the page cache
+        advise_mapping(self._idx_mm, "MADV_RANDOM")
+        self._index_layout, self._index_start = read_index_header(self._idx_mm)
+        self.index_packet_size = INDEX_ENTRY_SIZES[self._index_layout]
+        self._count = (len(self._idx_mm) - self._index_start) // self.index_packet_size
+        # Expected packet size, used for reading packets whose length is not in the
+        # index. Updated with the size of the last packet read, up to MAX_SIZE_HINT.
+        self._size_hint = 4096 - _U32_SIZE
+        # Read-only fds of recently used bin files (LRU order)
+        self._bin_fds: OrderedDict[int, int] = OrderedDict()
+        # Number of reads in flight for each fd. An fd evicted from the cache while it
+        # is still being read is closed by its last reader, so that the fd number is
+        # not reused for another file in the meantime.
+        self._fd_users: dict[int, int] = {}
+        self._evicted_fds: set[int] = set()
+        self._fd_lock = threading.Lock()
+        self._executor: ThreadPoolExecutor | None = None
+        if io_threads > 0:
+            self._executor = ThreadPoolExecutor(io_threads)
+        # Resources are released when the loader is garbage collected (or at exit),
+        # if close() is not called before
+        self._finalizer = weakref.finalize(
+            self,
+            release_loader_resources,
+            self._idx_mm,
+            self._bin_fds,
+            self._evicted_fds,
+            self._executor,
+        )
+
+    def close(self) -> None:
+        """Release the index mapping and close all cached bin files."""
+        self._finalizer()
+        self._executor = None
+        self._idx_mm = b""
+        self._count = 0
+
+    def __getstate__(self) -> dict[str, Any]:
+        # Mappings and fds cannot be pickled (eg: for "spawn" processes). The loader is
+        # created again from its arguments instead.
+        return {
+            "data_dir": str(self.data_dir_path),
+            "io_threads": self.io_threads,
+            "max_open_files": self.max_open_files,
+        }
+
+    def __setstate__(self, state: dict[str, Any]) -> None:
+        self.__init__(**state)
 
     def __len__(self) -> int:
         """
-        Calculate and return length of dataset.
+        Return length of dataset.
 
         Length calculated based on the size of the index file.
         """
-        index_file_size = self.index_file.stat().st_size
-        count = index_file_size // self.index_packet_size
-        return count
+        return self._count
+
+    def _acquire_fd(self, index: int) -> int:
+        """
+        Return a read-only fd for the bin file with the given index.
+
+        The fd is cached, evicting the least recently used one when the cache is full.
+        It stays open until it is handed back with _release_fd(), even if evicted.
+        """
+        with self._fd_lock:
+            fd = self._bin_fds.get(index)
+            if fd is not None:
+                self._bin_fds.move_to_end(index)
+            else:
+                path = get_bin_file_for_index(self.data_dir_path, index)
+                fd = os.open(path, os.O_RDONLY)
+                # Packets are read at random positions, read-ahead would be wasted
+                advise_file(fd, "POSIX_FADV_RANDOM")
+                self._bin_fds[index] = fd
+                if len(self._bin_fds) > self.max_open_files:
+                    _, old_fd = self._bin_fds.popitem(last=False)
+                    if old_fd in self._fd_users:
+                        self._evicted_fds.add(old_fd)
+                    else:
+                        os.close(old_fd)
+            self._fd_users[fd] = self._fd_users.get(fd, 0) + 1
+            return fd
+
+    def _release_fd(self, fd: int) -> None:
+        """Hand back an fd from _acquire_fd(). Closes it if it was evicted meanwhile."""
+        with self._fd_lock:
+            users = self._fd_users[fd] - 1
+            if users:
+                self._fd_users[fd] = users
+                return
+            del self._fd_users[fd]
+            if fd in self._evicted_fds:
+                self._evicted_fds.remove(fd)
+                os.close(fd)
+
+    def _get_entry(self, idx: int) -> tuple[int, int, int | None]:
+        """
+        Return (index, position, length) of the packet at idx from the index file.
+
+        length is None if the index does not store it (only the legacy layout does).
+        """
+        if not 0 <= idx < self._count:
+            raise ValueError(f"unable to read index entry for {idx=}")
+        offset = self._index_start + self.index_packet_size * idx
+        if self._index_layout == INDEX_LAYOUT_PACKED:
+            (value,) = _IDX_PACKED.unpack_from(self._idx_mm, offset)
+            return value >> _POSITION_BITS, value & _POSITION_MASK, None
+        if self._index_layout == INDEX_LAYOUT_WIDE:
+            index, position = _IDX_WIDE.unpack_from(self._idx_mm, offset)
+            return index, position, None
+        return _IDX.unpack_from(self._idx_mm, offset)
+
+    def _read_packet(self, fd: int, position: int, length: int | None) -> bytes:
+        """
+        Read the size prefixed packet at position in the bin file.
+
+        Packets of unknown length are read with a single read of the expected size,
+        followed by a second read only if the packet turns out to be larger.
+        """
+        read_size = _U32_SIZE + (self._size_hint if length is None else length)
+        packet = os.pread(fd, read_size, position)
+        if len(packet) < _U32_SIZE:
+            raise ValueError(f"unable to read packet at {position=}")
+        (packet_size,) = _U32.unpack_from(packet)
+        if length is None:
+            size_hint = min(packet_size, MAX_SIZE_HINT)
+            if size_hint != self._size_hint:
+                with self._fd_lock:
+                    self._size_hint = size_hint
+        elif packet_size != length:
+            raise ValueError(f"Size mismatch {packet_size} != {length}")
+        end = _U32_SIZE + packet_size
+        if len(packet) < end and len(packet) == read_size:
+            packet += os.pread(fd, end - len(packet), position + len(packet))
+        if len(packet) < end:
+            raise ValueError(f"unable to read packet at {position=}")
+        return packet[_U32_SIZE:end]
 
     def __getitem__(self, idx: int) -> bytes:
         """
@@ -168,47 +688,129 @@ class SplitDataLoader:
         the index file. Then read the packet from the bin file based on position and
         length.
         """
-        location = self.index_packet_size * idx
-        values = []
-
-        # Get index, position, length from index-file
-        with open(self.index_file, "rb") as reader:
-            reader.seek(location)
-            for value_idx in range(3):
-                valid, value = read_struct_unpack(reader)
-                if not valid:
-                    raise ValueError(f"unable to read value for {idx=} {value_idx=}")
-                values.append(value)
-
-        # Get the actual data packet from the bin file
-        index, position, length = values
-        bin_file = get_bin_file_for_index(self.data_dir_path, index)
-        data = b""
-        with open(bin_file, "rb") as reader:
-            reader.seek(position)
-            valid, packet_size = read_struct_unpack(reader)
-            if not valid:
-                raise ValueError(f"unable to read size for {idx=}")
-            if packet_size != length:
-                raise ValueError(f"Size mismatch {packet_size} != {length}")
-            data = reader.read(length)
-        return data
-
-    def iterate_binwise(self, shuffle: bool = False) -> Iterator[bytes]:
+        index, position, length = self._get_entry(idx)
+
+        # Get the actual data packet (size prefixed) from the bin file with a
+        # positional read. pread does not use the file offset, so the fds can be
+        # shared with forked processes.
+        fd = self._acquire_fd(index)
+        try:
+            return self._read_packet(fd, position, length)
+        finally:
+            self._release_fd(fd)
+
+    def get_batch(self, indices: Sequence[int]) -> list[bytes]:
+        """
+        Return the packets at the given indices (in the same order).
+
+        Lookups are grouped by bin and packets lying next to each other in a bin are
+        fetched with a single read, which is much faster than indexing one by one.
+        """
+        # For each bin: list of (position, length, slot in result)
+        groups: dict[int, list[tuple[int, int | None, int]]] = {}
+        for slot, idx in enumerate(indices):
+            index, position, length = self._get_entry(idx)
+            groups.setdefault(index, []).append((position, length, slot))
+
+        # Ranges to read: (bin index, packets in range, start, end). Packets of unknown
+        # length extend a range by at most MAX_SIZE_HINT.
+        size_hint = self._size_hint
+        runs: list[tuple[int, list[tuple[int, int | None, int]], int, int]] = []
+        for index, entries in groups.items():
+            entries.sort()
+            run: list[tuple[int, int | None, int]] = []
+            run_start = run_end = 0
+            for entry in entries:
+                position, length, _ = entry
+                if run and position > run_end:
+                    runs.append((index, run, run_start, run_end))
+                    run = []
+                if not run:
+                    run_start = run_end = position
+                run.append(entry)
+                if length is None:
+                    length = size_hint
+                run_end = max(run_end, position + _U32_SIZE + length)
+            if run:
+                runs.append((index, run, run_start, run_end))
+
+        result = [b""] * len(indices)
+        if self._executor is None:
+            for index, run, run_start, run_end in runs:
+                self._read_run(index, run, run_start, run_end, result)
+            return result
+
+        pending: list[Future[None]] = []
+        for index, run, run_start, run_end in runs:
+            pending.append(
+                self._executor.submit(
+                    self._read_run, index, run, run_start, run_end, result
+                )
+            )
+        for future in pending:
+            future.result()
+        return result
+
+    def __getitems__(self, indices: Sequence[int]) -> list[bytes]:
+        """Same as get_batch(). Used by PyTorch DataLoader for batched fetching."""
+        return self.get_batch(indices)
+
+    def _read_run(
+        self,
+        index: int,
+        run: list[tuple[int, int | None, int]],
+        run_start: int,
+        run_end: int,
+        result: list[bytes],
+    ) -> None:
+        """
+        Read a contiguous range of a bin file and slice out the packets in it.
+
+        The range end is only an estimate for packets of unknown length. Packets not
+        fully inside the range are read separately.
+        """
+        fd = self._acquire_fd(index)
+        try:
+            buffer = os.pread(fd, run_end - run_start, run_start)
+            for position, length, slot in run:
+                offset = position - run_start
+                end = offset + _U32_SIZE
+                if end <= len(buffer):
+                    (packet_size,) = _U32.unpack_from(buffer, offset)
+                    end += packet_size
+                    if length is not None and packet_size != length:
+                        raise ValueError(f"Size mismatch {packet_size} != {length}")
+                if end <= len(buffer):
+                    result[slot] = buffer[offset + _U32_SIZE : end]
+                else:
+                    result[slot] = self._read_packet(fd, position, length)
+        finally:
+            self._release_fd(fd)
+
+    def iterate_binwise(
+        self,
+        shuffle: bool = False,
+        prefetch: int = 0,
+        drop_cache: bool = False,
+        shuffle_chunk_size: int = SHUFFLE_CHUNK_SIZE,
+    ) -> Iterator[bytes]:
         """
         Iterate bin by bin (much faster than index based iteration).
 
         shuffle: if true, shuffle the order of bins and data inside bins.
+        prefetch: number of upcoming bins to read in the background while the current
+            one is being consumed (0 to disable)
+        shuffle_chunk_size: data inside a bin is shuffled in chunks of this many packets,
+            so that only one chunk is held in memory (0 to shuffle whole bins)
+        drop_cache: if true, drop each bin from the page cache once it is read. Useful
+            when the dataset is much larger than the memory.
         """
         bin_files = [str(p) for p in self.data_dir_path.rglob("bin*.dat")]
         if shuffle:
             random.shuffle(bin_files)
         else:
             bin_files.sort()
-        for bin_file in bin_files:
-            with open(bin_file, "rb") as reader:
-                packets = read_all_size_prefixed_packets(reader)
-                if shuffle:
-                    random.shuffle(packets)
-                for data in packets:
-                    yield data
+        for packets in iterate_bin_packets(bin_files, prefetch, drop_cache):
+            if shuffle:
+                packets = shuffle_in_chunks(packets, shuffle_chunk_size)
+            yield from packets
@@ -1,6 +1,11 @@
 from multiprocessing import Process, Queue
-from typing import Callable, Any, TypeVar, Generic, Self
+from multiprocessing.context import BaseContext
+from multiprocessing.shared_memory import SharedMemory
+from typing import Callable, Any, TypeVar, Generic, Self, cast
 import logging
+import multiprocessing
+import queue
+import threading
 
 logger = logging.getLogger(__name__)
 
@@ -11,14 +16,223 @@ class EndOfQueue:
     pass
 
 
+def item_size(item: Any) -> int:
+    """Size of the item in bytes, used for limiting the data in flight (0 if unknown)"""
+    if isinstance(item, (bytes, bytearray)):
+        return len(item)
+    nbytes = getattr(item, "nbytes", 0)
+    return nbytes if isinstance(nbytes, int) else 0
+
+
+class FlowControl:
+    """
+    Limits the items produced but not yet consumed (in flight), by count and by size.
+
+    depth: initial limit for the number of items in flight
+    max_depth: if larger than depth, the limit adapts between depth and max_depth after
+        every window of items. It is doubled if the consumer ran out of items while the
+        producer was held back by this limit (bursty producer), not by max_bytes. It is halved if more
+        than half of the limit stayed in flight for several windows in a row (slow
+        consumer).
+    max_bytes: if non-zero, limit for the total size of the items in flight. A single
+        item is always allowed, even if it is larger.
+    """
+
+    window = 64
+    # Number of calm windows in a row before shrinking
+    shrink_after = 8
+
+    def __init__(
+        self, ctx: BaseContext, depth: int, max_depth: int = 0, max_bytes: int = 0
+    ) -> None:
+        self.min_depth = depth
+        self.max_depth = max(depth, max_depth)
+        self.max_bytes = max_bytes
+        self.cond = ctx.Condition()
+        # Shared counters
+        self.depth = ctx.Value("q", depth, lock=False)
+        self.produced = ctx.Value("q", 0, lock=False)
+        self.consumed = ctx.Value("q", 0, lock=False)
+        self.consumed_bytes = ctx.Value("q", 0, lock=False)
+        self.producer_waits = ctx.Value("q", 0, lock=False)
+        # Producer waits caused by the depth (and not only by max_bytes)
+        self.depth_waits = ctx.Value("q", 0, lock=False)
+        # Producer only
+        self.produced_bytes = 0
+        # Consumer only
+        self.consumer_waits = 0
+        self.window_items = 0
+        self.window_starved = False
+        self.window_min_in_flight = depth
+        self.window_depth_waits = 0
+        self.calm_windows = 0
+
+    def is_full(self, size: int) -> bool:
+        in_flight = self.produced.value - self.consumed.value
+        if in_flight >= self.depth.value:
+            return True
+        in_flight_bytes = self.produced_bytes - self.consumed_bytes.value
+        return (
+            self.max_bytes > 0 and in_flight > 0 and in_flight_bytes + size > self.max_bytes
+        )
+
+    def acquire(self, size: int) -> None:
+        """Wait until an item of the given size can be produced (producer side)."""
+        with self.cond:
+            if self.is_full(size):
+                self.producer_waits.value += 1
+                at_depth = False
+                while self.is_full(size):
+                    in_flight = self.produced.value - self.consumed.value
+                    at_depth = at_depth or in_flight >= self.depth.value
+                    self.cond.wait()
+                if at_depth:
+                    self.depth_waits.value += 1
+            self.produced.value += 1
+        self.produced_bytes += size
+
+    def before_get(self) -> None:
+        """Record the state of the queue before taking an item (consumer side)."""
+        in_flight = self.produced.value - self.consumed.value
+        if in_flight == 0:
+            self.consumer_waits += 1
+            self.window_starved = True
+        self.window_min_in_flight = min(self.window_min_in_flight, in_flight)
+
+    def release(self, size: int) -> None:
+        """Mark an item of the given size as consumed (consumer side)."""
+        with self.cond:
+            self.consumed.value += 1
+            self.consumed_bytes.value += size
+            self.window_items += 1
+            if self.window_items == self.window:
+                self.adapt()
+            self.cond.notify()
+
+    def adapt(self) -> None:
+        """Update the depth at the end of a window (consumer side, locked)."""
+        depth = self.depth.value
+        depth_waits = self.depth_waits.value
+        if self.window_starved:
+            self.calm_windows = 0
+            if depth_waits > self.window_depth_waits:
+                depth = min(depth * 2, self.max_depth)
+        elif self.window_min_in_flight > depth // 2:
+            self.calm_windows += 1
+            if self.calm_windows == self.shrink_after:
+                self.calm_windows = 0
+                depth = max(depth // 2, self.min_depth)
+        else:
+            self.calm_windows = 0
+        self.depth.value = depth
+        self.window_items = 0
+        self.window_starved = False
+        self.window_min_in_flight = depth
+        self.window_depth_waits = depth_waits
+
+    def metrics(self) -> dict[str, int]:
+        return {
+            "depth": self.depth.value,
+            "in_flight": self.produced.value - self.consumed.value,
+            "consumed": self.consumed.value,
+            "consumed_bytes": self.consumed_bytes.value,
+            "producer_waits": self.producer_waits.value,
+            "consumer_waits": self.consumer_waits,
+        }
+
+
+class ShmSlot:
+    """
+    Placeholder sent through the queue for an item stored in the shared memory ring.
+    """
+
+    def __init__(self, start: int, size: int) -> None:
+        self.start = start
+        self.size = size
+
+
+class ShmRing:
+    """
+    Ring buffer in shared memory, used for passing bytes from the child process.
+
+    Positions are absolute byte counts and the offset in the buffer is
+    position % capacity. An item is never split: if it does not fit before the end of
+    the buffer, the remaining space is skipped. The queue carries the ShmSlot of each
+    item, so the order of items (and of other objects) is kept.
+    """
+
+    def __init__(self, ctx: BaseContext, capacity: int) -> None:
+        self.capacity = capacity
+        self.shm = SharedMemory(create=True, size=capacity)
+        # Position up to which the consumer has read (shared)
+        self.head = ctx.Value("q", 0, lock=False)
+        self.cond = ctx.Condition()
+        # Position up to which the producer has written (producer only)
+        self.tail = 0
+
+    def put(self, data: bytes) -> ShmSlot | None:
+        """
+        Copy data to the ring, waiting for space if required.
+
+        Returns None if the data is larger than the ring.
+        """
+        size = len(data)
+        if size > self.capacity:
+            return None
+        start = self.tail
+        offset = start % self.capacity
+        if offset + size > self.capacity:
+            start += self.capacity - offset
+            offset = 0
+        end = start + size
+        with self.cond:
+            # Wait until the space is free. The skipped space only counts while
+            # there are unread items before it.
+            while self.head.value < min(self.tail, end - self.capacity):
+                self.cond.wait()
+        buf = self.shm.buf
+        assert buf is not None
+        buf[offset : offset + size] = data
+        self.tail = end
+        return ShmSlot(start, size)
+
+    def get(self, slot: ShmSlot) -> bytes:
+        """Copy the item out of the ring and release its space."""
+        offset = slot.start % self.capacity
+        buf = self.shm.buf
+        assert buf is not None
+        data = bytes(buf[offset : offset + slot.size])
+        with self.cond:
+            self.head.value = slot.start + slot.size
+            self.cond.notify()
+        return data
+
+    def release(self) -> None:
+        """Free the shared memory (consumer side)."""
+        self.shm.close()
+        self.shm.unlink()
+
+
 def iterator_handler(
-    outq: Queue, itr_func: Callable, args: list[Any], kwargs: dict[str, Any]
+    outq: "Queue | queue.Queue",
+    itr_func: Callable,
+    args: list[Any],
+    kwargs: dict[str, Any],
+    ring: ShmRing | None = None,
+    flow: FlowControl | None = None,
 ) -> None:
     """
     creates an iterator using itr_func and pushes the results to outq.
+
+    If a ring is given, bytes items are passed through it instead of being pickled.
+    If a flow control is given, wait for the consumer before exceeding its limits.
     """
     try:
         for item in itr_func(*args, **kwargs):
+            if flow is not None:
+                flow.acquire(item_size(item))
+            if ring is not None and type(item) is bytes:
+                item = ring.put(item) or item
             outq.put(item)
     except Exception:
         logger.exception("Error while iterating")
@@ -29,6 +243,24 @@ def iterator_handler(
 class MpQItr(Generic[T]):
     """
     Run the iterator in a child process and yield the values.
+
+    The following attributes can be changed before starting the iteration.
+    qsize: maximum number of items waiting in the queue
+    qsize_max: if larger than qsize, the limit on the number of waiting items adapts
+        between qsize and qsize_max, based on how the producer and consumer keep up
+        with each other (see FlowControl)
+    max_bytes_in_flight: if non-zero, maximum total size of the items waiting in the
+        queue. Only bytes, bytearray, and objects with an nbytes attribute (eg: numpy
+        arrays) are counted.
+    shm_size: if non-zero, bytes items are passed through a shared memory ring of this
+        size instead of being pickled through the queue. Items larger than the ring
+        still go through the queue.
+    use_thread: if true, run the iterator in a thread of the current process instead.
+        Nothing is pickled, which suits iterators that spend their time in I/O
+        (releasing the GIL), eg: SplitDataLoader.iterate_binwise.
+    start_method: multiprocessing start method ("fork", "spawn", "forkserver") or None
+        for the platform default. With "fork", the child shares the memory mappings
+        (eg: the index of a SplitDataLoader) of the parent.
     """
 
     def __init__(self, itr_func: Callable, *args: Any, **kwargs: Any) -> None:
@@ -36,14 +268,50 @@ class MpQItr(Generic[T]):
         self.args = args
         self.kwargs = kwargs
         self.qsize = 16
+        self.qsize_max = 0
+        self.max_bytes_in_flight = 0
+        self.shm_size = 0
+        self.use_thread = False
+        self.start_method: str | None = None
+        self.ring: ShmRing | None = None
+        self.flow: FlowControl | None = None
 
     def __iter__(self) -> Self:
-        self.yield_q: Queue | None = Queue(self.qsize)
-        self.proc = Process(
-            target=iterator_handler,
-            args=(self.yield_q, self.itr_func, self.args, self.kwargs),
+        self.close()
+        ctx = multiprocessing.get_context(self.start_method)
+        self.flow = None
+        maxsize = self.qsize
+        if self.qsize_max > self.qsize or self.max_bytes_in_flight > 0:
+            self.flow = FlowControl(
+                ctx, self.qsize, self.qsize_max, self.max_bytes_in_flight
+            )
+            # The flow control limits the items, the queue only needs room for the end
+            # marker
+            maxsize = self.flow.max_depth + 1
+        self.yield_q: Queue | queue.Queue | None
+        self.proc: Process | threading.Thread | None
+        if self.use_thread:
+            self.yield_q = queue.Queue(maxsize)
+        else:
+            if self.shm_size > 0:
+                self.ring = ShmRing(ctx, self.shm_size)
+            self.yield_q = ctx.Queue(maxsize)
+        handler_args = (
+            self.yield_q,
+            self.itr_func,
+            self.args,
+            self.kwargs,
+            self.ring,
+            self.flow,
         )
-        self.proc.daemon = True
+        if self.use_thread:
+            self.proc = threading.Thread(
+                target=iterator_handler, args=handler_args, daemon=True
+            )
+        else:
+            self.proc = ctx.Process(  # pyright: ignore[reportAttributeAccessIssue]
+                target=iterator_handler, args=handler_args, daemon=True
+            )
         self.proc.start()
         return self
 
@@ -51,9 +319,39 @@ class MpQItr(Generic[T]):
         if self.yield_q is None:
             raise StopIteration
 
+        if self.flow is not None:
+            self.flow.before_get()
         item = self.yield_q.get()
         if isinstance(item, EndOfQueue):
             self.proc = None
             self.yield_q = None
+            self.close()
             raise StopIteration
+        if isinstance(item, ShmSlot):
+            assert self.ring is not None
+            item = cast(T, self.ring.get(item))
+        if self.flow is not None:
+            self.flow.release(item_size(item))
         return item
+
+    def metrics(self) -> dict[str, int]:
+        """
+        Return counters of the current (or last) iteration. Empty if neither qsize_max
+        nor max_bytes_in_flight is set, as nothing is tracked then.
+
+        depth: current limit on the number of waiting items
+        in_flight: number of items produced but not yet consumed
+        consumed, consumed_bytes: number and total size of the items consumed
+        producer_waits: number of times the producer had to wait for the consumer
+        consumer_waits: number of times the consumer had to wait for the producer
+        """
+        return {} if self.flow is None else self.flow.metrics()
+
+    def close(self) -> None:
+        """Free the shared memory ring, if any."""
+        if self.ring is not None:
+            self.ring.release()
+            self.ring = None
+
+    def __del__(self) -> None:
+        self.close()